@@ -1,14 +1,25 @@
 import os
+import functools
 import psycopg2
+import psycopg2.extensions
 import threading
 import time
 import urllib.parse
 import uuid
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import timedelta
+from psycopg2.pool import PoolError, ThreadedConnectionPool
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from streamlit_autorefresh import st_autorefresh
 from dotenv import load_dotenv
+from schema import (
+    DROP_INDEX_SQL, INVALID_INDEXES_SQL, MIGRATION_LOCK_ID, MIGRATION_POLL_SECONDS,
+    SCHEMA_READY_SQL, SCHEMA_STATEMENTS, MessageRow,
+)
 
 load_dotenv()
 
@@ -17,17 +28,10 @@ load_dotenv()
 # -----------------------------
 st.set_page_config(page_title="WhatsApp Chat Dashboard", page_icon="💬", layout="centered")
 
-# -----------------------------
-# Sidebar reset button
-# -----------------------------
-if st.sidebar.button("♻️ Reset App / Reconnect DB"):
-    st.cache_resource.clear()
-    st.cache_data.clear()
-    st.session_state.clear()
-    st.rerun()
-
 # -----------------------------
 # Authentication
+# Everything expensive (secrets, pinger, DB pool) sits below this gate,
+# so anonymous visitors never trigger Postgres connects or threads.
 # -----------------------------
 try:
     APP_PASSWORD = st.secrets["APP_PASSWORD"]
@@ -85,13 +89,32 @@ except Exception:
 
 API_ENABLED = True
 
+# -----------------------------
+# Shared HTTP session
+# Keeps TLS connections to Infobip / Render alive across pings and sends.
+# -----------------------------
+@st.cache_resource
+def get_http_session():
+    session = requests.Session()
+    session.mount("https://", HTTPAdapter(
+        pool_connections=10,
+        pool_maxsize=20,
+        max_retries=Retry(total=2, backoff_factor=0.2),
+    ))
+    return session
+
+# Infobip sends run here so the Send button never blocks the script rerun
+@st.cache_resource
+def get_send_executor():
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix="infobip-send")
+
 # -----------------------------
 # Keep FastAPI and Streamlit warm
 # Pings every 5 min — does NOT touch Neon DB
 # -----------------------------
 def ping_url(url):
     try:
-        requests.get(url, timeout=6)
+        get_http_session().get(url, timeout=6)
     except Exception:
         pass
 
@@ -103,217 +126,448 @@ def pinger_loop():
         ping_url(streamlit_url)
         time.sleep(300)
 
-threading.Thread(target=pinger_loop, daemon=True).start()
+# Started once per server process, not once per script rerun. The name
+# check also survives "Reset App", which clears cache_resource but can't
+# stop the already-running thread.
+@st.cache_resource
+def start_pinger():
+    for t in threading.enumerate():
+        if t.name == "keep-warm-pinger":
+            return t
+    t = threading.Thread(target=pinger_loop, name="keep-warm-pinger", daemon=True)
+    t.start()
+    return t
+
+start_pinger()
 
 # -----------------------------
-# Database connection (cached for life of session)
+# Prepared statements for the hot queries
+# PREPAREd once per pooled connection, so the 60s refresh only pays
+# for EXECUTE instead of a fresh parse+plan each time.
 # -----------------------------
-@st.cache_resource
-def get_db_connection():
-    conn = psycopg2.connect(DATABASE_URL)
+# Explicit column list instead of SELECT * — keeps row tuples stable
+# and narrow regardless of future schema additions.
+MESSAGE_COLUMNS = ", ".join(MessageRow._fields)
+
+PREPARED_STATEMENTS = (
+    "PREPARE fetch_all (int) AS "
+    f"SELECT {MESSAGE_COLUMNS} FROM messages "
+    "ORDER BY timestamp DESC, id DESC LIMIT $1",
+    "PREPARE fetch_phone (text, int) AS "
+    f"SELECT {MESSAGE_COLUMNS} FROM messages WHERE phone=$1 "
+    "ORDER BY timestamp DESC, id DESC LIMIT $2",
+    "PREPARE fetch_all_before (timestamp, int, int) AS "
+    f"SELECT {MESSAGE_COLUMNS} FROM messages WHERE (timestamp, id) < ($1, $2) "
+    "ORDER BY timestamp DESC, id DESC LIMIT $3",
+    "PREPARE fetch_phone_before (text, timestamp, int, int) AS "
+    f"SELECT {MESSAGE_COLUMNS} FROM messages WHERE phone=$1 AND (timestamp, id) < ($2, $3) "
+    "ORDER BY timestamp DESC, id DESC LIMIT $4",
+    "PREPARE fetch_all_since (timestamp) AS "
+    f"SELECT {MESSAGE_COLUMNS} FROM messages WHERE timestamp >= $1 ORDER BY timestamp ASC, id ASC",
+    "PREPARE fetch_phone_since (text, timestamp) AS "
+    f"SELECT {MESSAGE_COLUMNS} FROM messages WHERE phone=$1 AND timestamp >= $2 ORDER BY timestamp ASC, id ASC",
+    # timestamp is left to the column default, the same clock the webhook uses
+    "PREPARE ins_msg (text, text, text, text, text, text) AS "
+    "INSERT INTO messages (phone, message, direction, message_type, media_link, caption) "
+    "VALUES ($1, $2, $3, $4, $5, $6)",
+    "PREPARE upsert_contact (text, text) AS "
+    "INSERT INTO contacts (phone, name) VALUES ($1, $2) "
+    "ON CONFLICT(phone) DO UPDATE SET name=EXCLUDED.name",
+)
+
+class PreparedConnection(psycopg2.extensions.connection):
+    """psycopg2 connection that remembers whether PREPARED_STATEMENTS ran on it."""
+    prepared = False
+
+def prepare_statements(conn):
+    if conn.prepared:
+        return
     with conn.cursor() as cur:
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS messages (
-            id SERIAL PRIMARY KEY,
-            phone TEXT,
-            message TEXT,
-            direction TEXT,
-            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            message_type TEXT,
-            media_link TEXT,
-            caption TEXT
-        )
-        """)
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS contacts (
-            id SERIAL PRIMARY KEY,
-            phone TEXT UNIQUE,
-            name TEXT
-        )
-        """)
-        conn.commit()
-    return conn
+        for stmt in PREPARED_STATEMENTS:
+            cur.execute(stmt)
+    conn.commit()
+    conn.prepared = True
 
-def ensure_connection(conn):
-    """Reconnect only if the connection is genuinely broken."""
+# -----------------------------
+# One-shot schema migration
+# Runs once per server process on its own short-lived connection; the
+# to_regclass gate turns it into a single SELECT once the schema exists.
+# Autocommit, because the indexes are built CONCURRENTLY; the advisory
+# lock is the one the webhook's ensure_db polls for.
+# -----------------------------
+@st.cache_resource
+def run_migrations_once():
+    conn = psycopg2.connect(DATABASE_URL)
+    conn.autocommit = True
     try:
         with conn.cursor() as cur:
-            cur.execute("SELECT 1")
-        return conn
-    except Exception:
-        st.cache_resource.clear()
-        return get_db_connection()
-
-conn = get_db_connection()
+            while True:
+                cur.execute(SCHEMA_READY_SQL)
+                if cur.fetchone()[0]:
+                    break
+                cur.execute("SELECT pg_try_advisory_lock(%s)", (MIGRATION_LOCK_ID,))
+                if cur.fetchone()[0]:
+                    try:
+                        cur.execute(INVALID_INDEXES_SQL)
+                        for (name,) in cur.fetchall():
+                            cur.execute(DROP_INDEX_SQL.format(name))
+                        for stmt in SCHEMA_STATEMENTS:
+                            cur.execute(stmt)
+                    finally:
+                        cur.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_ID,))
+                    break
+                time.sleep(MIGRATION_POLL_SECONDS)
+    finally:
+        conn.close()
+    return True
 
 # -----------------------------
-# ✅ FIX 1 — Lightweight sidebar query
-# Fetches only distinct phone numbers — NOT all message content.
-# This was the single biggest source of unnecessary data transfer.
+# Database connection pool (shared by every session)
+# Each query checks a connection out and hands it back, so concurrent
+# sessions no longer fight over a single cached socket. When every
+# connection is checked out, a query waits for one to come back.
 # -----------------------------
-def fetch_distinct_phones(conn):
-    conn = ensure_connection(conn)
-    with conn.cursor() as cur:
-        cur.execute("SELECT DISTINCT phone FROM messages ORDER BY phone")
-        return [row[0] for row in cur.fetchall()]
+DB_POOL_MAX = 10
+DB_POOL_WAIT_SECONDS = 15
+
+class BlockingConnectionPool(ThreadedConnectionPool):
+    """ThreadedConnectionPool whose getconn waits for a free connection
+    instead of raising PoolError as soon as all of them are in use."""
+
+    def __init__(self, minconn, maxconn, *args, **kwargs):
+        self._slots = threading.BoundedSemaphore(maxconn)
+        super().__init__(minconn, maxconn, *args, **kwargs)
+
+    def getconn(self, key=None):
+        if not self._slots.acquire(timeout=DB_POOL_WAIT_SECONDS):
+            raise PoolError(f"no free database connection after {DB_POOL_WAIT_SECONDS}s")
+        try:
+            return super().getconn(key)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn=None, key=None, close=False):
+        try:
+            super().putconn(conn, key, close)
+        finally:
+            self._slots.release()
+
+@st.cache_resource
+def get_db_pool():
+    run_migrations_once()
+    return BlockingConnectionPool(1, DB_POOL_MAX, DATABASE_URL, connection_factory=PreparedConnection)
+
+@contextmanager
+def get_conn():
+    """Check a connection out of the pool; broken ones are closed, not reused."""
+    pool = get_db_pool()
+    conn = pool.getconn()
+    broken = False
+    try:
+        prepare_statements(conn)
+        yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+    finally:
+        pool.putconn(conn, close=broken)
+
+def retry_once(fn):
+    """Retry a DB call once on a dropped connection (e.g. Neon idle timeout)."""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        try:
+            return fn(*args, **kwargs)
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            return fn(*args, **kwargs)
+    return wrapper
 
 # -----------------------------
-# ✅ FIX 2 — Contacts cached for 5 minutes
-# Contacts rarely change, no need to re-fetch every 60 seconds.
-# _conn is prefixed with _ so Streamlit doesn't try to hash it.
+# ✅ FIX 1 — Lightweight sidebar query
+# One grouped query returns each conversation's phone and contact name —
+# NOT message content. Ordered by phone so the option list stays stable
+# while new messages arrive.
 # -----------------------------
-@st.cache_data(ttl=300)
-def fetch_contacts_cached(_conn):
-    _conn = ensure_connection(_conn)
-    with _conn.cursor() as cur:
-        cur.execute("SELECT phone, name FROM contacts")
-        return {phone: name for phone, name in cur.fetchall()}
+@st.cache_data(ttl=10, show_spinner=False)
+@retry_once
+def fetch_conversation_list():
+    with get_conn() as conn, conn.cursor() as cur:
+        cur.execute("""
+            SELECT m.phone, c.name
+            FROM messages m
+            LEFT JOIN contacts c USING (phone)
+            GROUP BY m.phone, c.name
+            ORDER BY m.phone
+        """)
+        return tuple(cur.fetchall())
+
+# Contact names and the selectbox's phone options, rebuilt once per cache
+# window rather than on every rerun.
+@st.cache_data(ttl=10, show_spinner=False)
+def fetch_sidebar_options():
+    conversations = fetch_conversation_list()
+    contacts = {phone: name for phone, name in conversations if name}
+    phone_options = ("All",) + tuple(phone for phone, _ in conversations)
+    return contacts, phone_options
 
 # -----------------------------
 # ✅ FIX 3 — Message fetch scoped to selected conversation only
 # We no longer fetch ALL messages on every refresh.
 # Only the selected contact's messages are pulled each cycle.
+# Cached per phone for 10s so every open tab shares one query per window.
+# Paged by keyset: `before` is the (timestamp, id) of the oldest row already
+# shown, so older pages never pay an OFFSET scan.
 # -----------------------------
-def fetch_messages(conn, phone: str):
-    conn = ensure_connection(conn)
-    with conn.cursor() as cur:
+PAGE_SIZE = 200
+
+@st.cache_data(ttl=10, show_spinner=False)
+@retry_once
+def fetch_messages(phone: str, limit: int = PAGE_SIZE, before=None):
+    with get_conn() as conn, conn.cursor() as cur:
+        if before is None:
+            if phone == "All":
+                cur.execute("EXECUTE fetch_all (%s)", (limit,))
+            else:
+                cur.execute("EXECUTE fetch_phone (%s, %s)", (phone, limit))
+        else:
+            before_ts, before_id = before
+            if phone == "All":
+                cur.execute("EXECUTE fetch_all_before (%s, %s, %s)", (before_ts, before_id, limit))
+            else:
+                cur.execute(
+                    "EXECUTE fetch_phone_before (%s, %s, %s, %s)",
+                    (phone, before_ts, before_id, limit),
+                )
+        # newest-first from the DB, rendered newest-last
+        return tuple(map(MessageRow._make, reversed(cur.fetchall())))
+
+# Incremental refresh: rows from slightly before the last timestamp this
+# session has rendered, served by idx_messages_phone_ts_id. The overlap
+# catches rows stamped earlier but committed later (a long webhook batch,
+# clock skew between writers); the caller drops ids it already holds.
+REFRESH_OVERLAP = timedelta(minutes=2)
+
+@st.cache_data(ttl=10, show_spinner=False)
+@retry_once
+def fetch_messages_since(phone: str, since):
+    since -= REFRESH_OVERLAP
+    with get_conn() as conn, conn.cursor() as cur:
         if phone == "All":
-            # "All" view: fetch only recent 200 messages to cap payload
-            cur.execute(
-                "SELECT * FROM messages ORDER BY timestamp DESC LIMIT 200"
-            )
-            rows = cur.fetchall()
-            return list(reversed(rows))
+            cur.execute("EXECUTE fetch_all_since (%s)", (since,))
         else:
-            cur.execute(
-                "SELECT * FROM messages WHERE phone=%s ORDER BY timestamp ASC",
-                (phone,)
-            )
-            return cur.fetchall()
+            cur.execute("EXECUTE fetch_phone_since (%s, %s)", (phone, since))
+        return tuple(map(MessageRow._make, cur.fetchall()))
 
-def insert_message(conn, phone, message_text, direction, msg_type, media_link="", caption=""):
-    conn = ensure_connection(conn)
-    with conn.cursor() as cur:
-        cur.execute("""
-            INSERT INTO messages (phone, message, direction, timestamp, message_type, media_link, caption)
-            VALUES (%s, %s, %s, %s, %s, %s, %s)
-        """, (phone, message_text, direction, datetime.utcnow(), msg_type, media_link, caption))
-    conn.commit()
+@retry_once
+def insert_message(phone, message_text, direction, msg_type, media_link="", caption=""):
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("EXECUTE ins_msg (%s, %s, %s, %s, %s, %s)", (phone, message_text, direction, msg_type, media_link, caption))
+        conn.commit()
 
-def upsert_contact(conn, phone, name):
-    conn = ensure_connection(conn)
-    with conn.cursor() as cur:
-        cur.execute("""
-            INSERT INTO contacts (phone, name)
-            VALUES (%s, %s)
-            ON CONFLICT(phone) DO UPDATE SET name=EXCLUDED.name
-        """, (phone, name))
-    conn.commit()
+@retry_once
+def upsert_contact(phone, name):
+    with get_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("EXECUTE upsert_contact (%s, %s)", (phone, name))
+        conn.commit()
 
 # -----------------------------
 # ✅ FIX 4 — Message count monitor
 # Lets you see DB growth without running a full SELECT *
 # -----------------------------
 @st.cache_data(ttl=300)
-def fetch_message_count(_conn):
-    _conn = ensure_connection(_conn)
-    with _conn.cursor() as cur:
+@retry_once
+def fetch_message_count():
+    with get_conn() as conn, conn.cursor() as cur:
         cur.execute("SELECT COUNT(*) FROM messages")
         return cur.fetchone()[0]
 
+# -----------------------------
+# Sidebar reset button (authenticated users only — it clears
+# shared resources for every session)
+# -----------------------------
+if st.sidebar.button("♻️ Reset App / Reconnect DB"):
+    # Not closeall(): other sessions may still hold connections from the
+    # old pool and would hit PoolError on putconn. Dropping it from the
+    # cache is enough; its connections close once it's garbage collected.
+    st.cache_resource.clear()
+    st.cache_data.clear()
+    st.session_state.clear()
+    st.rerun()
+
 # -----------------------------
 # ✅ FIX 5 — Autorefresh slowed from 15s → 60s
 # 4× fewer DB round-trips per hour at no cost to usability.
+# ✅ FIX 6 — …and backed off further while nothing is happening.
+# Each auto-refresh that brings no new messages doubles the interval
+# (60s → 120s → 240s → 5 min cap), so idle or background tabs stop
+# re-running the script every minute. New messages or any user
+# interaction drop it straight back to 60s.
 # -----------------------------
-st_autorefresh(interval=60000, key="messages_refresh")
+BASE_REFRESH_MS = 60000
+MAX_REFRESH_MS  = 300000
+
+idle_refreshes = st.session_state.get("idle_refreshes", 0)
+refresh_count = st_autorefresh(
+    interval=min(BASE_REFRESH_MS * 2 ** idle_refreshes, MAX_REFRESH_MS),
+    key="messages_refresh",
+)
+# The counter only moves on timer-driven reruns; anything else is the user
+is_auto_refresh = refresh_count != st.session_state.get("refresh_count")
+st.session_state.refresh_count = refresh_count
 
 # -----------------------------
 # Sidebar
 # -----------------------------
-conn = ensure_connection(conn)
-
-# Cheap: only phone numbers
-conversation_keys = fetch_distinct_phones(conn)
-
-# Cheap: cached for 5 min
-contacts = fetch_contacts_cached(conn)
+# Cheap: one small grouped row per conversation
+contacts, phone_options = fetch_sidebar_options()
 
-contact_display_names = ["All"] + [
-    f"{contacts.get(p, p)} ({p})" for p in conversation_keys
-]
+def conversation_label(phone: str) -> str:
+    return phone if phone == "All" else f"{contacts.get(phone, phone)} ({phone})"
 
 st.sidebar.title("📱 Contacts")
-selected_display = st.sidebar.selectbox("Select a conversation", contact_display_names)
+# Options are phones (labels come from format_func), so a renamed contact
+# doesn't change the options and reset the selection
+selected_phone = st.sidebar.selectbox(
+    "Select a conversation",
+    phone_options,
+    format_func=conversation_label,
+    key="selected_phone",
+)
 st.sidebar.write("---")
-st.sidebar.write("Total contacts:", len(conversation_keys))
+st.sidebar.write("Total contacts:", len(phone_options) - 1)
 
 # DB size monitor — cached, so costs nothing extra mid-cycle
-msg_count = fetch_message_count(conn)
+msg_count = fetch_message_count()
 st.sidebar.caption(f"📊 Total messages in DB: {msg_count:,}")
 
 if st.sidebar.button("🔄 Refresh Now"):
     st.cache_data.clear()
+    st.session_state.pop("chat_rows", None)
     st.rerun()
 
-selected_phone = (
-    "All" if selected_display == "All"
-    else selected_display.split("(")[-1].replace(")", "")
-)
-
-# Only fetch messages for the selected conversation
-chat_messages = fetch_messages(conn, selected_phone)
+def load_older_messages():
+    rows = st.session_state.chat_rows
+    oldest = rows[0]
+    older = fetch_messages(
+        st.session_state.chat_phone, before=(oldest.timestamp, oldest.id)
+    )
+    st.session_state.chat_rows = list(older) + rows
+    st.session_state.has_older = len(older) == PAGE_SIZE
+
+# Only fetch messages for the selected conversation.
+# Latest page on first visit or when the conversation changes; afterwards
+# each refresh just appends rows newer than the last one we hold.
+if (
+    st.session_state.get("chat_phone") != selected_phone
+    or not st.session_state.get("chat_rows")
+):
+    st.session_state.chat_phone = selected_phone
+    st.session_state.chat_rows = list(fetch_messages(selected_phone))
+    st.session_state.has_older = len(st.session_state.chat_rows) == PAGE_SIZE
+    st.session_state.idle_refreshes = 0
+else:
+    rows = st.session_state.chat_rows
+    held_ids = {r.id for r in rows}
+    new_rows = [
+        r for r in fetch_messages_since(selected_phone, st.session_state.last_ts)
+        if r.id not in held_ids
+    ]
+    if new_rows:
+        rows.extend(new_rows)
+        # late arrivals can be older than rows already held
+        rows.sort(key=lambda r: (r.timestamp, r.id))
+    st.session_state.idle_refreshes = (
+        idle_refreshes + 1 if is_auto_refresh and not new_rows else 0
+    )
+
+chat_messages = st.session_state.chat_rows
+if chat_messages:
+    st.session_state.last_ts = chat_messages[-1].timestamp
 
 # -----------------------------
 # Helpers
 # -----------------------------
+# lru_cache lives inside cache_resource: a plain module-level cache would be
+# thrown away on every script rerun.
+@st.cache_resource
+def get_proxy_url_builder():
+    @functools.lru_cache(maxsize=4096)
+    def proxy_url(media_identifier: str) -> str:
+        encoded = urllib.parse.quote_plus(media_identifier)
+        return f"{FASTAPI_PROXY_BASE}/media-proxy/{encoded}"
+    return proxy_url
+
+cached_proxy_url = get_proxy_url_builder()
+
 def build_proxy_url(media_identifier: str, direction: str = "inbound") -> str:
     if not media_identifier:
         return ""
-    if direction == "outbound" or media_identifier.startswith("http"):
+    if media_identifier[:4] == "http" or direction == "outbound":
         return media_identifier
-    encoded = urllib.parse.quote_plus(media_identifier)
-    return f"{FASTAPI_PROXY_BASE}/media-proxy/{encoded}"
+    return cached_proxy_url(media_identifier)
+
+# Bubble HTML templates, filled with str.format; media types dispatch
+# through _MEDIA_TEMPLATES instead of an if/elif ladder.
+_IMG_TMPL = (
+    "<a href='{proxy}' target='_blank'>"
+    "<img src='{proxy}' style='max-width:220px; border-radius:8px; border:1px solid #ddd;'>"
+    "</a>"
+)
+_VIDEO_TMPL = (
+    "<a href='{proxy}' target='_blank'>View Video</a><br>"
+    "<video width='260' controls><source src='{proxy}' type='video/mp4'></video>"
+)
+_AUDIO_TMPL = "<audio controls><source src='{proxy}' type='audio/mpeg'></audio>"
+_DOC_TMPL = "<a href='{proxy}' target='_blank'>Open Document</a>"
+_CAPTION_TMPL = "<div style='margin-top:6px'>{caption}</div>"
+# No leading indentation: the bubbles are joined into one st.markdown
+# call, and any line indented 4+ spaces after a blank line would render
+# as a code block.
+_BUBBLE_TMPL = (
+    "<div style='display:flex; justify-content:{align}; margin:8px 0;'>"
+    "<div style='max-width:72%; background:{bg}; padding:10px; border-radius:10px; border:1px solid #ddd;'>"
+    "<b>{display_name}</b><br><br>"
+    "{content}"
+    "<div style='text-align:right; font-size:11px; color:#666; margin-top:6px;'>{timestamp}</div>"
+    "</div>"
+    "</div>"
+)
+
+_MEDIA_TEMPLATES = {
+    "image": _IMG_TMPL,
+    "video": _VIDEO_TMPL,
+    "voice": _AUDIO_TMPL,
+    "audio": _AUDIO_TMPL,
+    "document": _DOC_TMPL,
+}
+
+def as_html_lines(text: str) -> str:
+    # Raw newlines would end the HTML block and leak into Markdown
+    return text.replace("\r\n", "<br>").replace("\n", "<br>")
 
-def render_bubble(msg_row):
-    _, phone, message_text, direction, timestamp, msg_type, media_link, caption = msg_row
-    display_name = f"{contacts.get(phone, phone)} ({phone})"
-    is_inbound   = direction == "inbound"
-    align        = "flex-start" if is_inbound else "flex-end"
-    bg           = "#ffffff" if is_inbound else "#dcf8c6"
+def render_bubble(row: MessageRow) -> str:
+    is_inbound = row.direction == "inbound"
+    msg_type = row.message_type
 
-    content_html = "<i>No content</i>"
     if msg_type == "text" or not msg_type:
-        content_html = message_text or "<i>No text content</i>"
-    elif msg_type in ("image", "video", "document", "voice", "audio"):
-        if media_link:
-            proxy = build_proxy_url(media_link, direction)
-            if msg_type == "image":
-                content_html = (
-                    f"<a href='{proxy}' target='_blank'>"
-                    f"<img src='{proxy}' style='max-width:220px; border-radius:8px; border:1px solid #ddd;'>"
-                    f"</a>"
-                )
-            elif msg_type == "video":
-                content_html = (
-                    f"<a href='{proxy}' target='_blank'>View Video</a><br>"
-                    f"<video width='260' controls><source src='{proxy}' type='video/mp4'></video>"
-                )
-            elif msg_type in ("voice", "audio"):
-                content_html = f"<audio controls><source src='{proxy}' type='audio/mpeg'></audio>"
-            elif msg_type == "document":
-                content_html = f"<a href='{proxy}' target='_blank'>Open Document</a>"
-            if caption:
-                content_html += f"<div style='margin-top:6px'>{caption}</div>"
-
-    st.markdown(f"""
-    <div style='display:flex; justify-content:{align}; margin:8px 0;'>
-      <div style='max-width:72%; background:{bg}; padding:10px; border-radius:10px; border:1px solid #ddd;'>
-        <b>{display_name}</b><br><br>
-        {content_html}
-        <div style='text-align:right; font-size:11px; color:#666; margin-top:6px;'>{timestamp}</div>
-      </div>
-    </div>
-    """, unsafe_allow_html=True)
+        content_html = as_html_lines(row.message) if row.message else "<i>No text content</i>"
+    elif row.media_link and msg_type in _MEDIA_TEMPLATES:
+        content_html = _MEDIA_TEMPLATES[msg_type].format(proxy=build_proxy_url(row.media_link, row.direction))
+        if row.caption:
+            content_html += _CAPTION_TMPL.format(caption=as_html_lines(row.caption))
+    else:
+        content_html = "<i>No content</i>"
+
+    return _BUBBLE_TMPL.format(
+        align="flex-start" if is_inbound else "flex-end",
+        bg="#ffffff" if is_inbound else "#dcf8c6",
+        display_name=f"{contacts.get(row.phone, row.phone)} ({row.phone})",
+        content=content_html,
+        timestamp=row.timestamp,
+    )
 
 # -----------------------------
 # Chat view
@@ -321,16 +575,21 @@ def render_bubble(msg_row):
 st.title("💬 WhatsApp Chat Dashboard (Live)")
 
 if selected_phone == "All":
-    st.subheader("💬 All Conversations (last 200 messages)")
+    st.subheader("💬 All Conversations")
 else:
-    label = f"{contacts.get(selected_phone, selected_phone)} ({selected_phone})"
-    st.subheader(f"💬 Chat with: {label}")
+    st.subheader(f"💬 Chat with: {conversation_label(selected_phone)}")
+
+if st.session_state.get("has_older"):
+    st.button("⬆️ Load older messages", on_click=load_older_messages)
 
 if not chat_messages:
     st.info("No messages yet for this contact.")
 else:
-    for m in chat_messages:
-        render_bubble(m)
+    # One st.markdown for the whole conversation instead of one per message
+    st.markdown(
+        "\n".join(render_bubble(m) for m in chat_messages),
+        unsafe_allow_html=True,
+    )
 
 # -----------------------------
 # Send new message
@@ -343,8 +602,6 @@ media_caption = st.text_input("Caption (optional)")
 
 if st.button("Send"):
     if recipient.strip() and (message_text.strip() or media_url.strip()):
-        conn = ensure_connection(conn)
-
         if media_url.strip():
             url_lower = media_url.lower()
             if url_lower.endswith((".jpg", ".jpeg", ".png", ".gif")):
@@ -367,8 +624,9 @@ if st.button("Send"):
             message_body = message_text.strip()
             caption      = ""
 
-        insert_message(conn, recipient, message_body, "outbound", msg_type, media_link, caption)
-        # Invalidate the contacts cache so new recipients appear immediately
+        insert_message(recipient, message_body, "outbound", msg_type, media_link, caption)
+        # Invalidate cached queries so the sender sees their own message
+        # and new recipients appear immediately
         st.cache_data.clear()
         st.success("✅ Message saved locally!")
 
@@ -395,13 +653,30 @@ if st.button("Send"):
                     "removeProtocol": True
                 }
             }
-            try:
-                response = requests.post(api_url, headers=headers, json=payload, timeout=15)
-                if response.status_code in (200, 201):
-                    st.success(f"✅ Message sent successfully to {recipient}!")
-                else:
-                    st.error(f"❌ API failed: {response.status_code} {response.text}")
-            except Exception as e:
-                st.error(f"⚠️ Connection error: {e}")
+            future = get_send_executor().submit(
+                get_http_session().post, api_url, headers=headers, json=payload, timeout=15
+            )
+            st.session_state.setdefault("pending_sends", []).append((recipient, future))
     else:
-        st.warning("Please fill recipient and message or media URL.")
\ No newline at end of file
+        st.warning("Please fill recipient and message or media URL.")
+
+# -----------------------------
+# Outbound send status
+# Polled on every rerun (including autorefresh); finished sends are
+# reported once and dropped.
+# -----------------------------
+still_pending = []
+for send_to, future in st.session_state.get("pending_sends", []):
+    if not future.done():
+        st.info(f"⏳ Sending to {send_to}…")
+        still_pending.append((send_to, future))
+        continue
+    try:
+        response = future.result()
+        if response.status_code in (200, 201):
+            st.success(f"✅ Message sent successfully to {send_to}!")
+        else:
+            st.error(f"❌ API failed: {response.status_code} {response.text}")
+    except Exception as e:
+        st.error(f"⚠️ Connection error: {e}")
+st.session_state.pending_sends = still_pending
\ No newline at end of file
@@ -0,0 +1,83 @@
+# schema.py
+# Table and index DDL shared by the Streamlit dashboard (app3.py) and the
+# webhook server (webhook_server.py), so both bootstrap the same schema.
+from collections import namedtuple
+
+CREATE_CONTACTS = """
+CREATE TABLE IF NOT EXISTS contacts (
+    id SERIAL PRIMARY KEY,
+    phone TEXT UNIQUE,
+    name TEXT
+)
+"""
+
+CREATE_MESSAGES = """
+CREATE TABLE IF NOT EXISTS messages (
+    id SERIAL PRIMARY KEY,
+    phone TEXT,
+    message TEXT,
+    direction TEXT,
+    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    message_type TEXT,
+    media_link TEXT,
+    caption TEXT
+)
+"""
+
+# Chat reads page newest-first: per conversation by phone, the "All" view
+# across everyone, both ordered by (timestamp DESC, id DESC). Matching the
+# keyset order exactly keeps each page a bounded index range scan with no
+# sort step. Built CONCURRENTLY so an existing messages table keeps taking
+# inserts meanwhile; that can't run inside a transaction block, so
+# SCHEMA_STATEMENTS are executed one by one in autocommit mode.
+CREATE_INDEXES = (
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_messages_phone_ts_id ON messages(phone, timestamp DESC, id DESC)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_messages_ts_id ON messages(timestamp DESC, id DESC)",
+)
+
+# Superseded by the (…, id DESC) indexes above; dropping them saves a
+# write per insert.
+DROP_OLD_INDEXES = (
+    "DROP INDEX CONCURRENTLY IF EXISTS idx_messages_phone_ts",
+    "DROP INDEX CONCURRENTLY IF EXISTS idx_messages_ts",
+)
+
+SCHEMA_STATEMENTS = (CREATE_CONTACTS, CREATE_MESSAGES) + CREATE_INDEXES + DROP_OLD_INDEXES
+
+# Both apps hold this session-level advisory lock while running
+# SCHEMA_STATEMENTS, so concurrent bootstraps don't race on the catalog.
+# It is taken with pg_try_advisory_lock and polled, never waited on: a
+# session blocked inside pg_advisory_lock() holds a snapshot that CREATE
+# INDEX CONCURRENTLY would in turn have to wait out.
+MIGRATION_LOCK_ID = 42
+MIGRATION_POLL_SECONDS = 1
+
+# Cheap idempotency gate, so callers can skip the DDL round-trips
+# entirely. True once both tables exist, every index above is built and
+# valid, and the superseded ones are gone. to_regclass alone isn't enough:
+# an interrupted CREATE INDEX CONCURRENTLY leaves an INVALID index behind
+# (and one still being built is invalid until it finishes).
+SCHEMA_TABLES = ("contacts", "messages")
+SCHEMA_INDEXES = ("idx_messages_phone_ts_id", "idx_messages_ts_id")
+OLD_INDEXES = ("idx_messages_phone_ts", "idx_messages_ts")
+_INDEX_OIDS = ", ".join(f"to_regclass('{name}')" for name in SCHEMA_INDEXES)
+SCHEMA_READY_SQL = "SELECT " + " AND ".join(
+    [f"to_regclass('{name}') IS NOT NULL" for name in SCHEMA_TABLES]
+    + [f"(SELECT count(*) FROM pg_index WHERE indisvalid AND indexrelid IN ({_INDEX_OIDS})) = {len(SCHEMA_INDEXES)}"]
+    + [f"to_regclass('{name}') IS NULL" for name in OLD_INDEXES]
+)
+
+# Leftover invalid indexes, dropped before SCHEMA_STATEMENTS so their
+# CREATE ... IF NOT EXISTS actually rebuilds them.
+INVALID_INDEXES_SQL = (
+    "SELECT indexrelid::regclass::text FROM pg_index "
+    f"WHERE NOT indisvalid AND indexrelid IN ({_INDEX_OIDS})"
+)
+DROP_INDEX_SQL = "DROP INDEX CONCURRENTLY IF EXISTS {}"
+
+# Row shape for message reads. Defined in an importable module (not the
+# Streamlit script) so rows survive st.cache_data's pickling.
+MessageRow = namedtuple(
+    "MessageRow",
+    "id phone message direction timestamp message_type media_link caption",
+)
@@ -1,78 +1,312 @@
 # webhook.py
 import os
+import asyncio
+import contextlib
+import hashlib
 import logging
+import socket
+import tempfile
+import time
 import urllib.parse
-import requests
-from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import StreamingResponse, JSONResponse
-from datetime import datetime
+from collections import OrderedDict
+import asyncpg
+import httpx
+import ijson
+import msgspec
+from fastapi import FastAPI, Request, HTTPException, Response
+from fastapi.responses import FileResponse, StreamingResponse, ORJSONResponse
 from dotenv import load_dotenv
-import psycopg2
+from schema import (
+    DROP_INDEX_SQL, INVALID_INDEXES_SQL, MIGRATION_LOCK_ID, MIGRATION_POLL_SECONDS,
+    SCHEMA_READY_SQL, SCHEMA_STATEMENTS,
+)
 
 load_dotenv()
 logging.basicConfig(level=logging.INFO)
 
-app = FastAPI(title="WhatsApp Webhook")
+app = FastAPI(title="WhatsApp Webhook", default_response_class=ORJSONResponse)
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 API_KEY = os.getenv("API_KEY")
 SENDER_NUMBER = os.getenv("SENDER_NUMBER")
 MEDIA_BASE_URL = "https://api.infobip.com"
 AUTH_HEADER = f"App {API_KEY}" if API_KEY else None
+MEDIA_URL_TEMPLATE = f"{MEDIA_BASE_URL}/whatsapp/1/senders/{SENDER_NUMBER}/media/{{}}"
 
 if not DATABASE_URL:
     logging.error("DATABASE_URL not set. Exiting.")
     raise RuntimeError("DATABASE_URL is required")
 
+# Bytes per media_proxy read/yield. Larger chunks mean fewer Python loop
+# iterations and ASGI sends per file; tune with MEDIA_CHUNK_SIZE.
+MEDIA_CHUNK_SIZE = int(os.getenv("MEDIA_CHUNK_SIZE", str(256 * 1024)))
+# Upstream headers passed through so browsers can seek video and
+# decode the raw (possibly still compressed) body.
+FORWARDED_MEDIA_HEADERS = ("Content-Length", "Content-Range", "Accept-Ranges", "Content-Encoding")
+# Upstream media sockets: no Nagle delay on small trailing segments.
+# Buffer sizes are left to the kernel: pinning SO_RCVBUF would switch off
+# receive-window autotuning and be clamped by net.core.rmem_max anyway.
+# (Downstream, asyncio/uvloop already set TCP_NODELAY on every accepted
+# connection.)
+UPSTREAM_SOCKET_OPTIONS = [
+    (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+]
+# Infobip media ids are immutable, so the id's digest (media_key) is a
+# strong ETag and browsers can keep the bytes for a day without
+# revalidating.
+MEDIA_CACHE_CONTROL = "private, max-age=86400, immutable"
+
 # -----------------------------
 # Database helpers
 # -----------------------------
-def get_pg_connection():
-    return psycopg2.connect(DATABASE_URL)
-
-def ensure_db():
-    conn = get_pg_connection()
-    with conn.cursor() as c:
-        c.execute("""
-        CREATE TABLE IF NOT EXISTS contacts (
-            id SERIAL PRIMARY KEY,
-            phone TEXT UNIQUE,
-            name TEXT
-        )
-        """)
-        c.execute("""
-        CREATE TABLE IF NOT EXISTS messages (
-            id SERIAL PRIMARY KEY,
-            phone TEXT,
-            message TEXT,
-            direction TEXT,
-            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            message_type TEXT,
-            media_link TEXT,
-            caption TEXT
-        )
-        """)
-        conn.commit()
-    conn.close()
-
-def insert_message(conn, phone, message_text, direction, msg_type, media_link="", caption=""):
-    with conn.cursor() as cursor:
-        cursor.execute("""
-            INSERT INTO messages (phone, message, direction, timestamp, message_type, media_link, caption)
-            VALUES (%s, %s, %s, %s, %s, %s, %s)
-        """, (phone, message_text, direction, datetime.utcnow(), msg_type, media_link, caption))
-    conn.commit()
-
-def upsert_contact(conn, phone, name):
-    with conn.cursor() as cursor:
-        cursor.execute("""
-            INSERT INTO contacts (phone, name)
-            VALUES (%s, %s)
-            ON CONFLICT(phone) DO UPDATE SET name=EXCLUDED.name
-        """, (phone, name))
-    conn.commit()
-
-ensure_db()
+# asyncpg pool, created on startup and kept on app.state.pg; DB I/O no
+# longer blocks the event loop. Sized so a webhook burst multiplexes over
+# warm connections to Neon. These are per worker process: the server
+# holds up to WEB_CONCURRENCY * PG_POOL_MAX connections, which must stay
+# under the database's max_connections.
+PG_POOL_MIN = int(os.getenv("PG_POOL_MIN", "1"))
+PG_POOL_MAX = int(os.getenv("PG_POOL_MAX", "20"))
+app.state.pg = None
+app.state.http = None
+app.state.media_cache = False
+app.state.media_sweeper = None
+app.state.drain_task = None
+
+# Schema bootstrap runs once at startup, not at import. Set
+# RUN_MIGRATIONS=0 on runtime workers when a separate job owns the DDL.
+RUN_MIGRATIONS = os.getenv("RUN_MIGRATIONS", "1") == "1"
+
+async def ensure_db():
+    # Own connection, not the pool's: no command_timeout, since a first
+    # index build on a large table can run far longer than any request.
+    conn = await asyncpg.connect(DATABASE_URL)
+    try:
+        # Cheap path: one SELECT once the schema exists. Otherwise one
+        # worker migrates while the rest poll until it's done.
+        while not await conn.fetchval(SCHEMA_READY_SQL):
+            if await conn.fetchval("SELECT pg_try_advisory_lock($1)", MIGRATION_LOCK_ID):
+                try:
+                    for (name,) in await conn.fetch(INVALID_INDEXES_SQL):
+                        await conn.execute(DROP_INDEX_SQL.format(name))
+                    for stmt in SCHEMA_STATEMENTS:
+                        await conn.execute(stmt)
+                finally:
+                    await conn.execute("SELECT pg_advisory_unlock($1)", MIGRATION_LOCK_ID)
+                break
+            await asyncio.sleep(MIGRATION_POLL_SECONDS)
+    finally:
+        await conn.close()
+
+# Statement text lives at module scope: asyncpg's per-connection statement
+# cache is keyed on the exact string, so every batch hits the same plan.
+SQL_INSERT_MSG = (
+    "INSERT INTO messages (phone, message, direction, message_type, media_link, caption) "
+    "VALUES ($1, $2, $3, $4, $5, $6)"
+)
+# One statement for a whole batch of contacts via unnest()
+SQL_UPSERT_CONTACTS = (
+    "INSERT INTO contacts (phone, name) "
+    "SELECT * FROM unnest($1::text[], $2::text[]) "
+    "ON CONFLICT(phone) DO UPDATE SET name=EXCLUDED.name"
+)
+
+async def insert_messages(conn, rows):
+    await conn.executemany(SQL_INSERT_MSG, rows)
+
+async def upsert_contacts(conn, rows):
+    # Duplicate phones are collapsed first (last name wins) since one
+    # INSERT ... ON CONFLICT can't touch the same row twice.
+    latest = dict(rows)
+    await conn.execute(SQL_UPSERT_CONTACTS, list(latest.keys()), list(latest.values()))
+
+# Process-local LRU of the last name written per phone. Most messages come
+# from senders whose name hasn't changed, so their contact upsert (a write
+# plus a WAL record) can be skipped.
+CONTACT_CACHE_SIZE = 10000
+_contact_cache = OrderedDict()
+
+def contacts_to_upsert(rows):
+    changed = []
+    for phone, name in dict(rows).items():
+        if _contact_cache.get(phone) == name:
+            _contact_cache.move_to_end(phone)
+        else:
+            changed.append((phone, name))
+    return changed
+
+def remember_contacts(rows):
+    # Only called after the upsert committed
+    for phone, name in rows:
+        _contact_cache[phone] = name
+        _contact_cache.move_to_end(phone)
+    while len(_contact_cache) > CONTACT_CACHE_SIZE:
+        _contact_cache.popitem(last=False)
+
+# Message batches at least this large go through binary COPY instead of INSERT
+COPY_THRESHOLD = 10
+# timestamp is left to the column's DEFAULT CURRENT_TIMESTAMP
+MESSAGE_COPY_COLUMNS = ["phone", "message", "direction", "message_type", "media_link", "caption"]
+
+async def copy_messages(conn, rows):
+    await conn.copy_records_to_table("messages", records=rows, columns=MESSAGE_COPY_COLUMNS)
+
+async def save_inbound(pool, parsed_messages):
+    contact_rows = []
+    message_rows = []
+    for text, msg_type, media_id, caption, sender, name in parsed_messages:
+        contact_rows.append((sender, name))
+        message_rows.append((sender, text, "inbound", msg_type, media_id, caption))
+
+    # Two batched statements and one commit per batch, not two per message
+    changed_contacts = contacts_to_upsert(contact_rows)
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            if changed_contacts:
+                await upsert_contacts(conn, changed_contacts)
+            if len(message_rows) >= COPY_THRESHOLD:
+                await copy_messages(conn, message_rows)
+            else:
+                await insert_messages(conn, message_rows)
+    remember_contacts(changed_contacts)
+
+# -----------------------------
+# Inbound persistence queue
+# The webhook only parses and enqueues, then ACKs; this worker drains the
+# queue in batches so Infobip's latency never depends on Neon's. A full
+# queue makes the webhook answer 503 so Infobip retries later.
+# Messages are already ACKed, so nothing here may silently drop them: a
+# batch that keeps failing is retried row by row, and rows that still
+# can't be saved go to a JSON-lines dead-letter file.
+# -----------------------------
+INBOUND_QUEUE_MAX = 10000
+DRAIN_BATCH_SIZE = 500
+DRAIN_WAIT_SECONDS = 0.1
+DRAIN_ATTEMPTS = 3
+DEAD_LETTER_PATH = os.getenv("INBOUND_DEAD_LETTER_PATH", "inbound_dead_letter.jsonl")
+DEAD_LETTER_FIELDS = ("text", "type", "media_id", "caption", "from", "name")
+# Errors caused by the row itself (e.g. a NUL byte in text); anything else
+# (connection loss, timeouts) would fail every row alike.
+ROW_ERRORS = (asyncpg.DataError, asyncpg.IntegrityConstraintViolationError)
+
+def write_dead_letters(rows):
+    with open(DEAD_LETTER_PATH, "ab") as f:
+        for row in rows:
+            f.write(msgspec.json.encode(dict(zip(DEAD_LETTER_FIELDS, row))) + b"\n")
+
+async def dead_letter(rows):
+    logging.error("Dead-lettering %d inbound messages to %s", len(rows), DEAD_LETTER_PATH)
+    try:
+        await asyncio.to_thread(write_dead_letters, rows)
+    except OSError:
+        logging.exception("Lost %d inbound messages: dead-letter write failed", len(rows))
+
+async def save_rows_individually(pool, rows):
+    # One transaction per row, so only the bad rows are set aside
+    for i, row in enumerate(rows):
+        try:
+            await save_inbound(pool, [row])
+        except ROW_ERRORS:
+            logging.exception("Inbound message from %s rejected", row[4])
+            await dead_letter([row])
+        except Exception:  # the worker must outlive any one bad batch
+            logging.exception("Saving inbound messages row by row failed")
+            await dead_letter(rows[i:])
+            return
+
+async def persist_batch(pool, batch):
+    for attempt in range(1, DRAIN_ATTEMPTS + 1):
+        try:
+            await save_inbound(pool, batch)
+            return
+        except Exception:  # the worker must outlive any one bad batch
+            if attempt == DRAIN_ATTEMPTS:
+                logging.exception("Batch of %d inbound messages failed %d times", len(batch), attempt)
+            else:
+                await asyncio.sleep(attempt)
+    await save_rows_individually(pool, batch)
+
+async def drain_worker(app):
+    queue = app.state.queue
+    while True:
+        batch = []
+        try:
+            batch.append(await queue.get())
+            while len(batch) < DRAIN_BATCH_SIZE:
+                try:
+                    batch.append(await asyncio.wait_for(queue.get(), DRAIN_WAIT_SECONDS))
+                except asyncio.TimeoutError:
+                    break
+            await persist_batch(app.state.pg, batch)
+        except asyncio.CancelledError:
+            # Shutdown stopped waiting for us; the in-flight batch was
+            # ACKed, so keep it (a partly saved one may be duplicated)
+            if batch:
+                await dead_letter(batch)
+            raise
+        finally:
+            for _ in batch:
+                queue.task_done()
+
+@app.on_event("startup")
+async def startup():
+    app.state.pg = await asyncpg.create_pool(
+        DATABASE_URL,
+        min_size=PG_POOL_MIN,
+        max_size=PG_POOL_MAX,
+        command_timeout=10,
+        # asyncpg already speaks the binary protocol and prepares every
+        # parameterised statement; keep those plans for the connection's
+        # life instead of the default 5 min, so bursts after a quiet spell
+        # don't re-parse.
+        max_cached_statement_lifetime=0,
+    )
+    if RUN_MIGRATIONS:
+        await ensure_db()
+    # Shared by every media fetch so TCP+TLS to api.infobip.com stays warm;
+    # HTTP/2 multiplexes concurrent media streams over one connection.
+    # It only ever talks to Infobip, so auth is a client default.
+    app.state.http = httpx.AsyncClient(
+        timeout=30,
+        transport=httpx.AsyncHTTPTransport(
+            http2=True,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+            socket_options=UPSTREAM_SOCKET_OPTIONS,
+        ),
+        headers={"Authorization": AUTH_HEADER or "", "Accept": "*/*"},
+    )
+    app.state.queue = asyncio.Queue(maxsize=INBOUND_QUEUE_MAX)
+    app.state.drain_task = asyncio.create_task(drain_worker(app))
+    try:
+        os.makedirs(MEDIA_CACHE_DIR, exist_ok=True)
+        app.state.media_cache = True
+        app.state.media_sweeper = asyncio.create_task(media_cache_sweeper())
+    except OSError as e:
+        logging.warning("Media cache disabled (%s): %s", MEDIA_CACHE_DIR, e)
+
+@app.on_event("shutdown")
+async def shutdown():
+    if app.state.drain_task is not None:
+        # flush what was already ACKed before the pool goes away
+        queue = app.state.queue
+        try:
+            await asyncio.wait_for(queue.join(), 10)
+        except asyncio.TimeoutError:
+            logging.error("Shutting down with %d inbound messages unsaved", queue.qsize())
+        app.state.drain_task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await app.state.drain_task
+        # anything still queued goes to the dead-letter file, not away
+        leftover = []
+        while not queue.empty():
+            leftover.append(queue.get_nowait())
+        if leftover:
+            await dead_letter(leftover)
+    if app.state.media_sweeper is not None:
+        app.state.media_sweeper.cancel()
+    if app.state.pg is not None:
+        await app.state.pg.close()
+    if app.state.http is not None:
+        await app.state.http.aclose()
 
 # -----------------------------
 # Health endpoint
@@ -85,109 +319,447 @@ def health():
 # Helpers for parsing messages
 # -----------------------------
 def extract_media_id_from_url(url: str) -> str:
-    try:
-        parsed = urllib.parse.urlparse(url)
-        return parsed.path.rstrip("/").split("/")[-1]
-    except Exception:
-        return url
-
-def parse_infobip_message(msg):
-    sender = msg.get("from")
-    if not sender:
+    # Only the last path segment is needed, so skip the full URL parser
+    return url.split("?", 1)[0].split("#", 1)[0].rstrip("/").rsplit("/", 1)[-1]
+
+# Typed view of one Infobip result; each streamed item is converted into
+# these by msgspec in C. Scalars accept any JSON scalar and are coerced
+# with str() below, as the dict-based parser did, so an oddly typed field
+# doesn't reject the message.
+Scalar = str | int | float | bool | None
+
+class InfobipText(msgspec.Struct):
+    body: Scalar = ""
+
+class InfobipContact(msgspec.Struct):
+    name: Scalar = ""
+
+class InfobipMessage(msgspec.Struct):
+    type: Scalar = "TEXT"
+    text: InfobipText | Scalar = None
+    caption: Scalar = None
+    mediaId: Scalar = None
+    id: Scalar = None
+    url: Scalar = None
+    mediaUrl: Scalar = None
+
+class InfobipResult(msgspec.Struct):
+    from_: Scalar = msgspec.field(default=None, name="from")
+    contact: InfobipContact | None = None
+    message: InfobipMessage | None = None
+
+def as_text(value) -> str:
+    return "" if value is None else str(value)
+
+def message_text(content: InfobipMessage) -> str:
+    t = content.text
+    return as_text(t.body if isinstance(t, InfobipText) else t)
+
+def parse_infobip_message(msg: InfobipResult):
+    if not msg.from_:
         return None
-    contact_name = msg.get("contact", {}).get("name", "").strip() or sender
-    content = msg.get("message", {}) or {}
-    msg_type_raw = str(content.get("type", "TEXT")).upper()
+    sender = as_text(msg.from_)
+    contact_name = (as_text(msg.contact.name).strip() if msg.contact else "") or sender
+    content = msg.message or InfobipMessage()
+    msg_type_raw = as_text(content.type).upper()
 
     text = ""
     media_identifier = ""
     caption = ""
     msg_type = "text"
 
-    if msg_type_raw == "TEXT":
-        t = content.get("text", "")
-        text = t.get("body","") if isinstance(t, dict) else str(t or "")
-        msg_type = "text"
-    elif msg_type_raw in ("IMAGE","VIDEO","DOCUMENT","VOICE","AUDIO"):
+    if msg_type_raw in ("IMAGE","VIDEO","DOCUMENT","VOICE","AUDIO"):
         msg_type = msg_type_raw.lower()
-        caption = content.get("caption","") or ""
-        media_id = content.get("mediaId") or content.get("id")
-        media_url = content.get("url") or content.get("mediaUrl")
+        caption = as_text(content.caption)
+        media_id = content.mediaId or content.id
+        media_url = content.url or content.mediaUrl
         if media_id:
-            media_identifier = str(media_id)
+            media_identifier = as_text(media_id)
         elif media_url:
-            media_identifier = extract_media_id_from_url(media_url)
+            media_identifier = extract_media_id_from_url(as_text(media_url))
     else:
-        t = content.get("text", "")
-        text = t.get("body","") if isinstance(t, dict) else str(t or "")
-        msg_type = "text"
+        text = message_text(content)
 
     return text, msg_type, media_identifier, caption, sender, contact_name
 
 # -----------------------------
 # Inbound webhook
 # -----------------------------
+# Bodies up to this size are read whole and decoded by msgspec in C;
+# larger or unsized (chunked) ones are stream-parsed so a big batch never
+# sits in memory as raw bytes plus a full dict tree.
+STREAM_PARSE_MIN_BYTES = int(os.getenv("STREAM_PARSE_MIN_BYTES", str(1024 * 1024)))
+# "messages" is an older alias of "results", only used when no "results"
+# items were sent.
+RESULT_PREFIXES = ("results.item", "messages.item")
+# Envelope shape InfobipInbound enforces on small bodies, checked event by
+# event on streamed ones: an object root, and results/messages arrays.
+ROOT_EVENTS = ("start_map", "map_key", "end_map")
+LIST_EVENTS = ("start_array", "end_array", "null")
+
+class InfobipInbound(msgspec.Struct):
+    results: list[msgspec.Raw] | None = None
+    messages: list[msgspec.Raw] | None = None
+
+inbound_decoder = msgspec.json.Decoder(InfobipInbound)
+result_decoder = msgspec.json.Decoder(InfobipResult)
+
+def parse_result(item, convert, out):
+    # A malformed item is skipped, not the whole delivery: a 4xx would make
+    # Infobip drop the good messages with it
+    try:
+        parsed = parse_infobip_message(convert(item))
+    except msgspec.ValidationError as e:
+        logging.warning("Skipping malformed Infobip result: %s", e)
+        return
+    if parsed:
+        out.append(parsed)
+
+def decode_inbound(body: bytes):
+    envelope = inbound_decoder.decode(body)
+    parsed = ([], [])
+    for items, out in zip((envelope.results, envelope.messages), parsed):
+        for raw in items or ():
+            parse_result(raw, result_decoder.decode, out)
+    return parsed
+
+async def stream_inbound(request: Request):
+    # One event parser over the body; each result item is assembled by an
+    # ObjectBuilder and reduced to a compact tuple as soon as it closes.
+    events = ijson.sendable_list()
+    parser = ijson.parse_coro(events, use_float=True)
+    parsed = ([], [])
+    builder = item_prefix = None
+
+    def convert(item):
+        return msgspec.convert(item, InfobipResult)
+
+    def consume():
+        nonlocal builder, item_prefix
+        for prefix, event, value in events:
+            if builder is None:
+                if prefix == "" and event not in ROOT_EVENTS:
+                    raise msgspec.ValidationError("Expected `object`, got a non-object root")
+                if prefix in ("results", "messages") and event not in LIST_EVENTS:
+                    raise msgspec.ValidationError(f"Expected `array | null` - at `$.{prefix}`")
+                if prefix not in RESULT_PREFIXES:
+                    continue
+                builder, item_prefix = ijson.ObjectBuilder(), prefix
+                builder.event(event, value)
+                if event in ("start_map", "start_array"):
+                    continue
+            else:
+                builder.event(event, value)
+                if prefix != item_prefix or event not in ("end_map", "end_array"):
+                    continue
+            parse_result(builder.value, convert, parsed[RESULT_PREFIXES.index(item_prefix)])
+            builder = None
+        del events[:]
+
+    async for chunk in request.stream():
+        parser.send(chunk)
+        consume()
+    parser.close()
+    consume()
+    return parsed
+
 @app.post("/whatsapp/inbound")
 async def inbound(request: Request):
     try:
-        payload = await request.json()
-    except Exception:
+        size = int(request.headers.get("content-length", ""))
+    except ValueError:
+        size = None
+    try:
+        if size is not None and size <= STREAM_PARSE_MIN_BYTES:
+            parsed_messages, parsed_aliased = decode_inbound(await request.body())
+        else:
+            parsed_messages, parsed_aliased = await stream_inbound(request)
+    except (msgspec.DecodeError, ijson.JSONError):
         raise HTTPException(status_code=400, detail="Invalid JSON")
 
-    results = payload.get("results", []) or payload.get("messages", [])
-    if not results:
-        return JSONResponse({"status":"ok","received":0})
+    parsed_messages = parsed_messages or parsed_aliased
+    if not parsed_messages:
+        return ORJSONResponse({"status":"ok","received":0})
+
+    queue = request.app.state.queue
+    if len(parsed_messages) > queue.maxsize:
+        # Could never fit at once, so a 503 would only make Infobip retry
+        # it forever: feed it in as the worker frees room instead
+        for parsed in parsed_messages:
+            await queue.put(parsed)
+        return {"status":"ok","received":len(parsed_messages)}
+    # Check room for the whole payload first so a 503 never leaves it
+    # half-enqueued (Infobip would then redeliver the enqueued part too)
+    if queue.maxsize - queue.qsize() < len(parsed_messages):
+        raise HTTPException(status_code=503, detail="Inbound queue full, retry later")
+    for parsed in parsed_messages:
+        queue.put_nowait(parsed)
+    return {"status":"ok","received":len(parsed_messages)}
+
+# -----------------------------
+# Media disk cache
+# Media ids are immutable, so a full download is kept on local disk keyed
+# by media_key(media_id) and later hits never leave the box. A sidecar
+# "<key>.type" file holds the Content-Type; a periodic sweeper trims the
+# least recently used files once the directory exceeds its byte cap.
+# -----------------------------
+MEDIA_CACHE_DIR = os.getenv("MEDIA_CACHE_DIR", "/var/cache/media")
+MEDIA_CACHE_MAX_BYTES = int(os.getenv("MEDIA_CACHE_MAX_BYTES", str(1024 ** 3)))
+MEDIA_CACHE_SWEEP_SECONDS = 600
+# A ".tmp-*" download untouched this long was orphaned (crash, failed
+# cleanup); live downloads bump its mtime on every chunk.
+MEDIA_CACHE_TMP_MAX_AGE = 3600
+
+def media_key(media_id: str) -> str:
+    # Hex digest: safe as a file name and inside a quoted ETag whatever
+    # characters the id itself contains
+    return hashlib.sha256(media_id.encode()).hexdigest()
+
+def media_cache_path(key: str) -> str:
+    return os.path.join(MEDIA_CACHE_DIR, key)
 
-    conn = get_pg_connection()
-    received = 0
+def remove_quietly(path):
     try:
-        for msg in results:
-            parsed = parse_infobip_message(msg)
-            if not parsed:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def sweep_media_cache():
+    entries = []
+    stale_before = time.time() - MEDIA_CACHE_TMP_MAX_AGE
+    with os.scandir(MEDIA_CACHE_DIR) as it:
+        for entry in it:
+            # ".type" sidecars go with their media file below
+            if entry.name.endswith(".type"):
                 continue
-            text, msg_type, media_id, caption, sender, name = parsed
-            upsert_contact(conn, sender, name)
-            insert_message(conn, sender, text, "inbound", msg_type, media_id, caption)
-            received += 1
-        return {"status":"ok","received":received}
-    finally:
-        conn.close()
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue  # published or removed since listing
+            if entry.name.startswith(".tmp-"):
+                if stat.st_mtime < stale_before:
+                    remove_quietly(entry.path)
+            elif not entry.name.startswith("."):
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= MEDIA_CACHE_MAX_BYTES:
+            break
+        remove_quietly(path)
+        remove_quietly(path + ".type")
+        total -= size
+
+async def media_cache_sweeper():
+    while True:
+        await asyncio.sleep(MEDIA_CACHE_SWEEP_SECONDS)
+        try:
+            await asyncio.to_thread(sweep_media_cache)
+        except OSError:
+            logging.exception("Media cache sweep failed")
+
+def publish_cache_file(tmp, cache_path, content_type):
+    # tee complete: publish atomically so readers never see a partial file
+    tmp.close()
+    with open(cache_path + ".type", "w") as f:
+        f.write(content_type)
+    os.replace(tmp.name, cache_path)
+
+def discard_cache_tmp(tmp):
+    try:
+        tmp.close()
+    except OSError:
+        pass  # still unlink below
+    try:
+        os.remove(tmp.name)
+    except OSError:
+        logging.warning("Could not remove %s; the sweeper will retry", tmp.name)
 
 # -----------------------------
 # Media proxy endpoint
 # -----------------------------
+def etag_matches(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    return bool(if_none_match) and (
+        if_none_match.strip() == "*"
+        or etag in (t.strip().removeprefix("W/") for t in if_none_match.split(","))
+    )
+
+def cached_media(request: Request, key: str):
+    """Return (path, content_type) for a media key on local disk, else None."""
+    if not request.app.state.media_cache:
+        return None
+    cache_path = media_cache_path(key)
+    try:
+        # mark as recently used, so the sweeper won't pick it next
+        os.utime(cache_path)
+    except FileNotFoundError:
+        return None  # never cached, or swept meanwhile
+    try:
+        with open(cache_path + ".type") as f:
+            cached_type = f.read()
+    except FileNotFoundError:
+        cached_type = "application/octet-stream"
+    return cache_path, cached_type
+
 @app.get("/media-proxy/{media_identifier}")
-def media_proxy(media_identifier: str):
+async def media_proxy(media_identifier: str, request: Request):
     if not AUTH_HEADER or not SENDER_NUMBER:
         raise HTTPException(status_code=500, detail="Media proxy misconfigured")
 
     media_id = urllib.parse.unquote_plus(media_identifier)
-    url = f"{MEDIA_BASE_URL}/whatsapp/1/senders/{SENDER_NUMBER}/media/{media_id}"
-    headers = {"Authorization": AUTH_HEADER, "Accept": "*/*"}
+    key = media_key(media_id)
+    etag = f'"{key}"'
+    cache_headers = {"ETag": etag, "Cache-Control": MEDIA_CACHE_CONTROL}
+
+    # Conditional re-request: answer 304 without touching Infobip at all
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=cache_headers)
+
+    cached = cached_media(request, key)
+    if cached:
+        # FileResponse handles Range itself, so seeking works from cache too
+        return FileResponse(cached[0], media_type=cached[1], headers=cache_headers)
+
+    cache_path = media_cache_path(key) if request.app.state.media_cache else None
+    url = MEDIA_URL_TEMPLATE.format(media_id)
+    headers = {}
+    range_header = request.headers.get("range")
+    # <video> always opens with "bytes=0-", i.e. the whole file: fetch it
+    # without Range so it can be cached (a 200 is a valid answer to that).
+    # Any other range is forwarded as is.
+    if range_header and not (cache_path and range_header.replace(" ", "") == "bytes=0-"):
+        headers["Range"] = range_header
 
     try:
-        resp = requests.get(url, headers=headers, stream=True, timeout=30)
+        http = request.app.state.http
+        req = http.build_request("GET", url, headers=headers)
+        resp = await http.send(req, stream=True)
     except Exception as e:
         raise HTTPException(status_code=502, detail=f"Error fetching media: {e}")
 
-    if resp.status_code != 200:
-        raise HTTPException(status_code=resp.status_code, detail=f"Infobip error: {resp.status_code} {resp.text[:500]}")
+    if resp.status_code not in (200, 206):
+        body = await resp.aread()
+        await resp.aclose()
+        raise HTTPException(status_code=resp.status_code, detail=f"Infobip error: {resp.status_code} {body[:500].decode(errors='replace')}")
 
     content_type = resp.headers.get("Content-Type","application/octet-stream")
+    out_headers = {h: resp.headers[h] for h in FORWARDED_MEDIA_HEADERS if h in resp.headers}
+    out_headers.update(cache_headers)
+    if "Content-Encoding" in resp.headers:
+        # still-encoded bytes aren't the identity representation
+        out_headers["ETag"] = "W/" + etag
 
-    def iter_stream():
+    # Only complete, unencoded bodies are cached; partial (206) or
+    # still-compressed responses are just proxied.
+    cacheable = (
+        cache_path is not None
+        and resp.status_code == 200
+        and "Content-Encoding" not in resp.headers
+    )
+
+    # Cache-side failures (ENOSPC, EIO, ...) only stop the tee; the client's
+    # download carries on. Disk writes run off the event loop.
+    async def iter_stream():
+        tmp = None
+        if cacheable:
+            try:
+                tmp = tempfile.NamedTemporaryFile(dir=MEDIA_CACHE_DIR, prefix=".tmp-", delete=False)
+            except OSError:
+                logging.exception("Media cache write failed")
         try:
-            for chunk in resp.iter_content(chunk_size=8192):
-                if chunk:
-                    yield chunk
+            # raw bytes: no decompress/re-chunk pass through Python
+            async for chunk in resp.aiter_raw(MEDIA_CHUNK_SIZE):
+                if tmp is not None:
+                    try:
+                        await asyncio.to_thread(tmp.write, chunk)
+                    except OSError:
+                        logging.exception("Media cache write failed")
+                        discard_cache_tmp(tmp)
+                        tmp = None
+                yield chunk
+            if tmp is not None:
+                try:
+                    await asyncio.to_thread(publish_cache_file, tmp, cache_path, content_type)
+                except OSError:
+                    logging.exception("Media cache write failed")
+                    discard_cache_tmp(tmp)
+                tmp = None
         finally:
-            resp.close()
+            await resp.aclose()
+            if tmp is not None:
+                # client went away or upstream failed mid-stream
+                discard_cache_tmp(tmp)
+
+    return StreamingResponse(
+        iter_stream(),
+        status_code=resp.status_code,
+        media_type=content_type,
+        headers=out_headers,
+    )
+
+# Metadata only: browsers and caches probing with HEAD get type, length
+# and validators without any body bytes being pulled from Infobip.
+@app.head("/media-proxy/{media_identifier}")
+async def media_head(media_identifier: str, request: Request):
+    if not AUTH_HEADER or not SENDER_NUMBER:
+        raise HTTPException(status_code=500, detail="Media proxy misconfigured")
 
-    return StreamingResponse(iter_stream(), media_type=content_type)
+    media_id = urllib.parse.unquote_plus(media_identifier)
+    key = media_key(media_id)
+    etag = f'"{key}"'
+    headers = {"ETag": etag, "Cache-Control": MEDIA_CACHE_CONTROL}
+
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+
+    cached = cached_media(request, key)
+    if cached:
+        headers.update({
+            "Content-Type": cached[1],
+            "Content-Length": str(os.path.getsize(cached[0])),
+            "Accept-Ranges": "bytes",
+        })
+        return Response(headers=headers)
+
+    try:
+        resp = await request.app.state.http.head(MEDIA_URL_TEMPLATE.format(media_id))
+    except Exception as e:
+        raise HTTPException(status_code=502, detail=f"Error fetching media: {e}")
+    if resp.status_code != 200:
+        raise HTTPException(status_code=resp.status_code, detail=f"Infobip error: {resp.status_code}")
+
+    for h in ("Content-Type",) + FORWARDED_MEDIA_HEADERS:
+        if h in resp.headers:
+            headers[h] = resp.headers[h]
+    if "Content-Encoding" in resp.headers:
+        headers["ETag"] = "W/" + etag
+    return Response(headers=headers)
 
 # -----------------------------
-# Run server locally (for dev)
+# Run server
+# WEB_CONCURRENCY worker processes on uvloop+httptools. Each async worker
+# can keep a CPU busy on its own, so the default is one per usable CPU
+# (not gunicorn's 2*cores+1, which is meant for sync workers). Each worker
+# also gets its own DB pool, queue and media sweeper.
+# In production prefer:
+#   gunicorn -k uvicorn.workers.UvicornWorker -w $WEB_CONCURRENCY webhook_server:app
 # -----------------------------
+def default_workers() -> int:
+    # CPUs this process may run on; os.cpu_count() reports the whole host
+    # inside a container
+    try:
+        return len(os.sched_getaffinity(0)) or 1
+    except AttributeError:  # not available on macOS/Windows
+        return 1
+
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    uvicorn.run(
+        "webhook_server:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=int(os.getenv("WEB_CONCURRENCY", default_workers())),
+        loop="uvloop",
+        http="httptools",
+        backlog=int(os.getenv("UVICORN_BACKLOG", "4096")),
+    )